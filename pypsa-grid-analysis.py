@@ -29,66 +29,60 @@ MIT
 
 import pypsa
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 import pandas as pd
 import numpy as np
 
+def read_network(path):
+    """
+    Read a PyPSA network and assign lines and links the country of bus0
+    """
+    network = pypsa.Network(path)
+    # one bus lookup for both, a Series maps faster than a dict
+    country = network.buses.country
+    network.links['country'] = network.links.bus0.map(country)
+    network.lines['country'] = network.lines.bus0.map(country)
+    # calculate_dependent_values() is not needed, it only adds per-unit
+    # impedances and v_nom of the lines is already stored in the networks
+    return network
+
+# read only the used columns, named in file order, in place of the
+# second header row:
+# Substation_1 Full_name, Longitude/Latitude_Substation_1,
+# Substation_2 Full_name, Longitude/Latitude_Substation_2,
+# Voltage_level(kV), Fixed (Imax in A), Resistance_R(Ω),
+# Reactance_X(Ω), Susceptance_B(μS), Length_(km)
 netzmodell = pd.read_csv(
     "data/StatischesNetzmodell_Datentabelle2023.csv",
-    header=[0,1]
-)
-
-netzmodell = netzmodell[[
-    ('Substation_1','Full_name'),
-    ('Longitude_Substation_1','Unnamed: 5_level_1'),
-    ('Latitude_Substation_1','Unnamed: 6_level_1'),
-    ('Substation_2','Full_name'),
-    ('Longitude_Substation_2','Unnamed: 9_level_1'),
-    ('Latitude_Substation_2','Unnamed: 10_level_1'),
-    ('Unnamed: 18_level_0','Fixed'),
-    ('Unnamed: 11_level_0','Voltage_level(kV)'),
-    ('Electrical Parameters','Resistance_R(Ω)'),
-    ('Unnamed: 22_level_0','Reactance_X(Ω)'),
-    ('Unnamed: 23_level_0','Susceptance_B(μS)'),
-    ('Unnamed: 24_level_0','Length_(km)'),
-]]
-netzmodell.columns = netzmodell.columns.droplevel(level=0)
-
-netzmodell = netzmodell.rename(
-    columns = {
-        "Unnamed: 5_level_1": "lon1",
-        "Unnamed: 6_level_1": "lat1",
-        "Unnamed: 9_level_1": "lon2",
-        "Unnamed: 10_level_1": "lat2",
-        "Fixed": "MVA",
-        "Resistance_R(Ω)": "r",
-        "Reactance_X(Ω)": "x",
-        "Susceptance_B(μS)": "b",
-        "Length_(km)": "length",
-        "Voltage_level(kV)": "kV",
-    }
+    header=1,
+    usecols=[3, 5, 6, 7, 9, 10, 11, 18, 21, 22, 23, 24],
+    names=['Sub1', 'lon1', 'lat1', 'Sub2', 'lon2', 'lat2', 'kV', 'MVA', 'r', 'x', 'b', 'length'],
 )
 
 # from I to MVA
-netzmodell.MVA = netzmodell.MVA * netzmodell.kV / 1e3 * np.sqrt(3)
+netzmodell['MVA'] = netzmodell.MVA.to_numpy() * netzmodell.kV.to_numpy() / 1e3 * np.sqrt(3)
 
-# rename columns
-netzmodell.columns = ['Sub1', 'lon1', 'lat1', 'Sub2', 'lon2', 'lat2', 'MVA', 'kV', 'r', 'x', 'b', 'length']
-
-# generate a non-unique line name to capture lines with same routes for grouping
-netzmodell['line_name'] = (
-    netzmodell[['Sub1', 'Sub2']]
-    .apply(lambda row: ' '.join(sorted([row['Sub1'], row['Sub2']])), axis=1)
+# generate a non-unique integer key from the unordered pair of substation
+# codes to capture lines with same routes for grouping
+codes, _ = pd.factorize(
+    np.concatenate([netzmodell.Sub1.to_numpy(), netzmodell.Sub2.to_numpy()])
 )
+code1, code2 = np.split(codes.astype(np.int64), 2)
+netzmodell['line_key'] = np.minimum(code1, code2) << 32 | np.maximum(code1, code2)
 
-def parallel_resistance(series):
-    """
-    Formula for equivalent parallel resistance
-    """
-    return 1 / sum(1 / series)
+# parallel lines add up as reciprocals of resistance and reactance, a
+# missing value on any parallel line leaves the equivalent missing as well
+netzmodell['inv_r'] = 1 / netzmodell.r
+netzmodell['inv_x'] = 1 / netzmodell.x
+netzmodell['nan_r'] = netzmodell.r.isna()
+netzmodell['nan_x'] = netzmodell.x.isna()
 
 netzmodell = (
-    netzmodell.groupby("line_name")
+    netzmodell[[
+        'line_key', 'lon1', 'lon2', 'lat1', 'lat2', 'MVA', 'kV',
+        'inv_r', 'inv_x', 'nan_r', 'nan_x', 'b', 'length', 'Sub1', 'Sub2',
+    ]]
+    .groupby("line_key", sort=False, as_index=False)
     .agg({
         "lon1": "mean",
         "lon2": "mean",
@@ -96,164 +90,171 @@ netzmodell = (
         "lat2": "mean",
         "MVA": "sum",
         "kV": "mean",
-        "r": parallel_resistance,
-        "x": parallel_resistance,
+        "inv_r": "sum",
+        "inv_x": "sum",
+        "nan_r": "any",
+        "nan_x": "any",
         "b": "mean",
         "length": "mean",
         "Sub1": "first",
         "Sub2": "first",
         })
-    .reset_index()
 )
+netzmodell['r'] = (1 / netzmodell.pop('inv_r')).mask(netzmodell.pop('nan_r'))
+netzmodell['x'] = (1 / netzmodell.pop('inv_x')).mask(netzmodell.pop('nan_x'))
 
 netzmodell = netzmodell.loc[:, ~netzmodell.columns.duplicated(keep='last')]
 
 # read PyPSA-Eur network
-n = pypsa.Network("data/base_eur_50Hertz.nc")
-n.links['country'] = n.links.bus0.map(n.buses.country)
-n.lines['country'] = n.lines.bus0.map(n.buses.country)
-n.calculate_dependent_values()
+n = read_network("data/base_eur_50Hertz.nc")
 
 # read PyPSA-Earth network
-m = pypsa.Network("data/base_earth_50Hertz.nc")
-m.links['country'] = m.links.bus0.map(m.buses.country)
-m.lines['country'] = m.lines.bus0.map(m.buses.country)
-m.calculate_dependent_values()
+m = read_network("data/base_earth_50Hertz.nc")
 
 folium_map = folium.Map(location=[n.buses.y[0], n.buses.x[0]], zoom_start=5)
 
+def marker_callback(color):
+    """
+    JavaScript callback for FastMarkerCluster, draws a marker with the
+    popup from the third data column and one shared icon per layer
+    """
+    return f"""(function () {{
+        var icon = L.AwesomeMarkers.icon({{
+            extraClasses: "fa-rotate-0",
+            icon: "map-marker",
+            iconColor: "white",
+            markerColor: "{color}",
+            prefix: "glyphicon",
+        }});
+        return function (row) {{
+            var marker = L.marker(new L.LatLng(row[0], row[1]));
+            marker.setIcon(icon);
+            marker.bindPopup(row[2]);
+            return marker;
+        }};
+    }})()"""
+
+def add_bus_layer(lat, lon, popups, color, name):
+    """
+    Add buses as a single FastMarkerCluster layer to the map, the markers
+    are created in the browser from one array of [lat, lon, popup] rows
+    """
+    FastMarkerCluster(
+        data=list(zip(lat.tolist(), lon.tolist(), popups.tolist())),
+        callback=marker_callback(color),
+        name=name,
+    ).add_to(folium_map)
+
 # Add a buses as marker to the map
-bus_cluster = MarkerCluster(name="PyPSA-Eur buses").add_to(folium_map)
-for index, bus in n.buses.query("country == 'DE'").iterrows():
-    if bus.carrier not in ["AC", "DC"]:
-        continue
-
-    color_local = "gray"
-
-    marker = folium.Marker(
-        name="Substations",
-        location=[bus.y, bus.x],
-        popup=index,
-        icon=folium.Icon(icon="map-marker", color=color_local),
-    )
-    marker.add_to(bus_cluster)
-
-bus_cluster_earth = MarkerCluster(name="PyPSA-Earth buses").add_to(folium_map)
-for index, bus in m.buses.query("country == 'DE'").iterrows():
-    if bus.carrier not in ["AC", "DC"]:
-        continue
-
-    color_local = "black"
-
-    marker = folium.Marker(
-        name="Substations",
-        location=[bus.y, bus.x],
-        popup=index,
-        icon=folium.Icon(icon="map-marker", color=color_local),
-    )
-    marker.add_to(bus_cluster_earth)
-
-seen = []
-bus_cluster_50 = MarkerCluster(name="50Hertz buses").add_to(folium_map)
-for index, bus in netzmodell.iterrows():
-    color_local = "red"
-
-    if bus.Sub1 not in seen:
-        marker = folium.Marker(
-            name="Substations 50Hertz",
-            location=[bus.lat1, bus.lon1],
-            popup=bus.Sub1,
-            icon=folium.Icon(icon="map-marker", color=color_local),
-        )
-        marker.add_to(bus_cluster_50)
-        seen.append(bus.Sub1)
-
-    if bus.Sub2 not in seen:
-        marker = folium.Marker(
-            name="Substations 50Hertz",
-            location=[bus.lat2, bus.lon2],
-            popup=bus.Sub2,
-            icon=folium.Icon(icon="map-marker", color=color_local),
-        )
-        marker.add_to(bus_cluster_50)
-        seen.append(bus.Sub2)
+buses = n.buses.query("country == 'DE' and carrier in ['AC', 'DC']")
+add_bus_layer(buses.y, buses.x, buses.index, "gray", "PyPSA-Eur buses")
+
+buses = m.buses.query("country == 'DE' and carrier in ['AC', 'DC']")
+add_bus_layer(buses.y, buses.x, buses.index, "black", "PyPSA-Earth buses")
+
+# unique 50Hertz substations, interleaved so each keeps its first-listed coordinates
+substations = (
+    pd.concat([
+        netzmodell[['Sub1', 'lat1', 'lon1']].set_axis(['Sub', 'lat', 'lon'], axis=1),
+        netzmodell[['Sub2', 'lat2', 'lon2']].set_axis(['Sub', 'lat', 'lon'], axis=1),
+    ])
+    .sort_index(kind="stable")
+    .drop_duplicates('Sub')
+)
+
+add_bus_layer(substations.lat, substations.lon, substations.Sub, "red", "50Hertz buses")
+
+def add_bus_coordinates(df, buses):
+    """
+    Attach the coordinates of bus0 (y0, x0) and bus1 (y1, x1) to branches
+    """
+    for i in ["0", "1"]:
+        coordinates = buses[["y", "x"]].rename(columns=lambda c: c + i)
+        df = df.merge(coordinates, how="left", left_on="bus" + i, right_index=True)
+    return df
+
+def add_branch_layer(coordinates, popups, color, name):
+    """
+    Add branches as a single GeoJson layer of line strings to the map,
+    coordinates are (from, to) pairs of (lat, lon)
+    """
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": branch},
+            "properties": {"popup": html},
+        }
+        # GeoJSON orders coordinates as (lon, lat)
+        for branch, html in zip(coordinates[:, :, ::-1].tolist(), popups)
+    ]
+    # an empty layer stays in the layer control, but GeoJsonPopup fails
+    # without any feature to take the popup field from
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        style_function=lambda feature: {"color": color},
+        popup=folium.GeoJsonPopup(fields=["popup"], labels=False) if features else None,
+    ).add_to(folium_map)
 
 # Add lines as branches to map
-line_cluster_base = MarkerCluster(name="PyPSA-Eur lines").add_to(folium_map)
-for index, line in n.lines.query("country == 'DE'").iterrows():
-    # branch coordinates
-    coordinates_from = n.buses.loc[line.bus0, ["y", "x"]].values
-    coordinates_to = n.buses.loc[line.bus1, ["y", "x"]].values
-    coordinates = [coordinates_from, coordinates_to]
-
-    color = "gray"
-    line_cluster = line_cluster_base
-    # add to map
-    html = f"s_nom: {line.s_nom} <br>length: {line.length} <br>kV: {line.v_nom} <br>r: {line.r}<br>x: {line.x}"
-    folium.PolyLine(coordinates, popup=html, color=color).add_to(line_cluster)
-
-
-line_cluster_earth = MarkerCluster(name="PyPSA-Earth lines").add_to(folium_map)
-for index, line in m.lines.query("country == 'DE'").iterrows():
-    # branch coordinates
-    coordinates_from = m.buses.loc[line.bus0, ["y", "x"]].values
-    coordinates_to = m.buses.loc[line.bus1, ["y", "x"]].values
-    coordinates = [coordinates_from, coordinates_to]
-
-    color = "black"
-    line_cluster = line_cluster_earth
-    # add to map
-    html = f"s_nom: {line.s_nom} <br>length: {line.length} <br>kV: {line.v_nom} <br>r: {line.r}<br>x: {line.x}"
-    folium.PolyLine(coordinates, popup=html, color=color).add_to(line_cluster)
+lines = add_bus_coordinates(n.lines.query("country == 'DE'"), n.buses)
+lines["popup"] = (
+    "s_nom: " + lines.s_nom.astype(str)
+    + " <br>length: " + lines.length.astype(str)
+    + " <br>kV: " + lines.v_nom.astype(str)
+    + " <br>r: " + lines.r.astype(str)
+    + "<br>x: " + lines.x.astype(str)
+)
+coordinates = lines[["y0", "x0", "y1", "x1"]].to_numpy().reshape(-1, 2, 2)
+add_branch_layer(coordinates, lines.popup, "gray", "PyPSA-Eur lines")
+
+
+lines = add_bus_coordinates(m.lines.query("country == 'DE'"), m.buses)
+lines["popup"] = (
+    "s_nom: " + lines.s_nom.astype(str)
+    + " <br>length: " + lines.length.astype(str)
+    + " <br>kV: " + lines.v_nom.astype(str)
+    + " <br>r: " + lines.r.astype(str)
+    + "<br>x: " + lines.x.astype(str)
+)
+coordinates = lines[["y0", "x0", "y1", "x1"]].to_numpy().reshape(-1, 2, 2)
+add_branch_layer(coordinates, lines.popup, "black", "PyPSA-Earth lines")
 
 
 # Add links as branches to map
-link_cluster_earth = MarkerCluster(name="PyPSA-Earth links").add_to(folium_map)
-for index, line in m.links.query("country == 'DE'").iterrows():
-    if line.carrier not in ["AC", "DC"]:
-        continue
-
-    # branch coordinates
-    coordinates_from = m.buses.loc[line.bus0, ["y", "x"]].values
-    coordinates_to = m.buses.loc[line.bus1, ["y", "x"]].values
-    coordinates = [coordinates_from, coordinates_to]
-
-    color = "black"
-    link_cluster = link_cluster_earth
-    # add to map
-    html = f"{index}p_nom: {line.p_nom}<br>p_nom_max: {line.p_nom_max}"
-    folium.PolyLine(coordinates, popup=html, color=color).add_to(link_cluster)
-
-link_cluster_base = MarkerCluster(name="PyPSA-Eur links").add_to(folium_map)
-for index, line in n.links.query("country == 'DE'").iterrows():
-    if line.carrier not in ["AC", "DC"]:
-        continue
-
-    # branch coordinates
-    coordinates_from = n.buses.loc[line.bus0, ["y", "x"]].values
-    coordinates_to = n.buses.loc[line.bus1, ["y", "x"]].values
-    coordinates = [coordinates_from, coordinates_to]
-
-    color = "gray"
-    link_cluster = link_cluster_base
-    # add to map
-    html = f"{index}p_nom: {line.p_nom}<br>p_nom_max: {line.p_nom_max}"
-    folium.PolyLine(coordinates, popup=html, color=color).add_to(link_cluster)
+links = add_bus_coordinates(
+    m.links.query("country == 'DE' and carrier in ['AC', 'DC']"), m.buses
+)
+links["popup"] = (
+    links.index.to_series()
+    + "p_nom: " + links.p_nom.astype(str)
+    + "<br>p_nom_max: " + links.p_nom_max.astype(str)
+)
+coordinates = links[["y0", "x0", "y1", "x1"]].to_numpy().reshape(-1, 2, 2)
+add_branch_layer(coordinates, links.popup, "black", "PyPSA-Earth links")
+
+links = add_bus_coordinates(
+    n.links.query("country == 'DE' and carrier in ['AC', 'DC']"), n.buses
+)
+links["popup"] = (
+    links.index.to_series()
+    + "p_nom: " + links.p_nom.astype(str)
+    + "<br>p_nom_max: " + links.p_nom_max.astype(str)
+)
+coordinates = links[["y0", "x0", "y1", "x1"]].to_numpy().reshape(-1, 2, 2)
+add_branch_layer(coordinates, links.popup, "gray", "PyPSA-Eur links")
 
 
 # Add lines as branches to map
-line_cluster_50 = MarkerCluster(name="50Hertz lines").add_to(folium_map)
-for index, line in netzmodell.iterrows():
-    # branch coordinates
-    coordinates_from = line.loc[["lat1", "lon1"]].values
-    coordinates_to = line.loc[["lat2", "lon2"]].values
-    coordinates = [coordinates_from, coordinates_to]
-
-    color = "red"
-    line_cluster_2 = line_cluster_50
-    # add to map
-    html = f"s_nom: {line.MVA} <br>length: {line.length} <br>kV: {line.kV} <br>r: {line.r},<br>x: {line.x}"
-    folium.PolyLine(coordinates, popup=html, color=color).add_to(line_cluster_2)
+netzmodell["popup"] = (
+    "s_nom: " + netzmodell.MVA.astype(str)
+    + " <br>length: " + netzmodell.length.astype(str)
+    + " <br>kV: " + netzmodell.kV.astype(str)
+    + " <br>r: " + netzmodell.r.astype(str)
+    + ",<br>x: " + netzmodell.x.astype(str)
+)
+coordinates = netzmodell[["lat1", "lon1", "lat2", "lon2"]].to_numpy().reshape(-1, 2, 2)
+add_branch_layer(coordinates, netzmodell.popup, "red", "50Hertz lines")
 
 
 folium.LayerControl().add_to(folium_map)